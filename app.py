@@ -1,8 +1,11 @@
-from flask import Flask, render_template, request, jsonify
-from rag import answer_query
+import json
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from rag import answer_queries, load_index_if_present, stream_answer
 from ingest import build_index
 
 app = Flask(__name__)
+# Skip key sorting when serializing responses
+app.json.sort_keys = False
 
 
 @app.route("/ingest_local", methods=["POST"])
@@ -25,12 +28,36 @@ def ask():
     q = data.get("question", "").strip()
     if not q:
         return jsonify({"error": "empty question"}), 400
+
+    # Server-Sent Events: a "citations" event first, then "delta" events with answer text
+    def events():
+        try:
+            for event in stream_answer(q, top_k=4):
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/ask_batch", methods=["POST"])
+async def ask_batch():
+    data = request.get_json()
+    questions = [q.strip() for q in data.get("questions", []) if isinstance(q, str) and q.strip()]
+    if not questions:
+        return jsonify({"error": "no questions"}), 400
     try:
-        resp = answer_query(q, top_k=4)
-        return jsonify(resp)
+        results = await answer_queries(questions, top_k=4)
+        return jsonify({"results": results})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    # Development server only; in production run `gunicorn app:app` (see gunicorn.conf.py)
+    load_index_if_present()
+    app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,17 @@
+# gunicorn.conf.py -- used automatically by `gunicorn app:app`
+bind = "0.0.0.0:5000"
+workers = 4
+worker_class = "gthread"
+threads = 8
+# Import the app once in the master; the index itself is loaded per worker (see below)
+preload_app = True
+# Re-ingesting or waiting on the LLM can take a while
+timeout = 300
+
+
+def post_worker_init(worker):
+    # Load the index after the fork: FAISS, numba and torch start OpenMP thread pools,
+    # which are not fork-safe, so none of that may run in the master. The embeddings,
+    # chunks and FAISS index are memory-mapped, so workers still share them via the page cache.
+    import rag
+    rag.load_index_if_present()
@@ -1,29 +1,139 @@
 # ingest.py
+import hashlib
 import json
 import os
+from contextlib import contextmanager
 import numpy as np
+import torch
 from tqdm import tqdm
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
+try:
+    import faiss
+except ImportError:  # rag.py falls back to a numba search and needs no saved index
+    faiss = None
+
 load_dotenv()
 
 # Model for local embeddings (small & fast). Change if you want another.
 EMBED_MODEL = "all-MiniLM-L6-v2"
 
-CHUNK_SIZE = 500
+# Token windows stay well under the model's 256-token limit; overlap keeps context across cuts
+CHUNK_TOKENS = 200
+CHUNK_OVERLAP = 40
+ENCODE_BATCH_SIZE = 1024
+# CPU-only ingests larger than this are spread over one worker process per core
+MULTI_PROCESS_MIN_CHUNKS = 1000
+MULTI_PROCESS_BATCH_SIZE = 64
 DATA_FILE = "data/docs.json"
 EMBED_FILE = "data/embeddings.npy"
 META_FILE = "data/metadata.json"
+CHUNKS_FILE = "data/chunks.txt"
+INDEX_FILE = "data/index.faiss"
+# Hash of the metadata.json the saved index was built alongside, to detect a stale index
+INDEX_FINGERPRINT_FILE = "data/index.fingerprint"
+ONNX_MODEL_DIR = "onnx_model"
+
+# Above this many chunks, switch from exact search to HNSW approximate search
+HNSW_THRESHOLD = 100_000
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+
+def file_fingerprint(path):
+    """SHA-256 hex digest of a file's contents."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def normalize_rows(x):
+    """L2-normalize each row of x, returning a contiguous float32 array."""
+    x = np.array(x, dtype=np.float32)
+    x /= np.clip(np.linalg.norm(x, axis=1, keepdims=True), 1e-12, None)
+    return x
+
+def build_faiss_index(vectors):
+    """Build an inner-product FAISS index over L2-normalized vectors (cosine similarity).
+
+    Vectors are stored as float16 inside the index to halve memory and bandwidth.
+    """
+    vectors = normalize_rows(vectors)
+    dim = vectors.shape[1]
+    if vectors.shape[0] > HNSW_THRESHOLD:
+        idx = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        idx.hnsw.efSearch = HNSW_EF_SEARCH
+    else:
+        idx = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    idx.train(vectors)
+    idx.add(vectors)
+    return idx
+
+def chunk_text(text, tokenizer, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    """Split text into overlapping windows of at most max_tokens tokens."""
+    # Slice the original text via offsets rather than decode(), which would lowercase
+    # and re-space it (and mangle URLs / curl snippets).
+    enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+    offsets = enc["offset_mapping"]
+    chunks = []
+    for start in range(0, len(offsets), max_tokens - overlap):
+        window = offsets[start:start + max_tokens]
+        chunks.append(text[window[0][0]:window[-1][1]])
+        if start + max_tokens >= len(offsets):
+            break
+    return chunks
+
+@contextmanager
+def _env(name, value):
+    """Temporarily set an environment variable, restoring the previous value afterwards."""
+    prev = os.environ.get(name)
+    os.environ[name] = value
+    try:
+        yield
+    finally:
+        if prev is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = prev
+
+def embed_chunks(model, text_chunks, batch_size=ENCODE_BATCH_SIZE):
+    """Embed chunks from pre-tokenized, length-sorted batches; returns L2-normalized float32 vectors."""
+    tokenizer = model.tokenizer
+    # Tokenize the whole corpus in one call instead of once per batch inside model.encode,
+    # letting the Rust fast tokenizer use every core
+    with _env("TOKENIZERS_PARALLELISM", "true"):
+        enc = tokenizer(text_chunks, padding=False, truncation=True, max_length=model.max_seq_length)
+    # Sort by length so each batch pads to similar lengths, then restore the original order
+    order = np.argsort([len(ids) for ids in enc["input_ids"]], kind="stable")
+
+    embeddings = np.empty((len(text_chunks), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    with torch.inference_mode():
+        for start in tqdm(range(0, len(order), batch_size), desc="Batches"):
+            batch_idx = order[start:start + batch_size]
+            features = tokenizer.pad({k: [enc[k][i] for i in batch_idx] for k in enc.keys()}, return_tensors="pt")
+            features = {k: v.to(model.device) for k, v in features.items()}
+            # Run the model's own module pipeline (pooling, normalization, ...) on the padded batch
+            embeddings[batch_idx] = model(features)["sentence_embedding"].float().cpu().numpy()
+    return normalize_rows(embeddings)
 
-def chunk_text(text, max_length=CHUNK_SIZE):
-    return [text[i:i+max_length] for i in range(0, len(text), max_length)]
+def embed_chunks_multi_process(model, text_chunks, batch_size=MULTI_PROCESS_BATCH_SIZE):
+    """Embed chunks with one sentence-transformers worker process per CPU core."""
+    n_workers = os.cpu_count() or 1
+    # Workers are spawned and read this at torch import; one thread each avoids oversubscription
+    with _env("OMP_NUM_THREADS", "1"):
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * n_workers)
+    try:
+        embeddings = model.encode_multi_process(text_chunks, pool, batch_size=batch_size)
+    finally:
+        model.stop_multi_process_pool(pool)
+    return normalize_rows(embeddings)
 
 def build_index():
     print("Loading docs...")
     with open(DATA_FILE, "r", encoding="utf-8") as f:
         docs = json.load(f)
 
+    print("Loading sentence-transformers model:", EMBED_MODEL)
+    model = SentenceTransformer(EMBED_MODEL)
+
     text_chunks = []
     metas = []
 
@@ -33,7 +143,7 @@ def build_index():
         url = doc.get("url", "")
         if not content:
             continue
-        chunks = chunk_text(content)
+        chunks = chunk_text(content, model.tokenizer)
         for cid, chunk in enumerate(chunks):
             text_chunks.append(chunk)
             metas.append({
@@ -41,24 +151,82 @@ def build_index():
                 "chunk_id": cid,
                 "title": title,
                 "url": url,
-                "text_excerpt": chunk[:400]
             })
 
     print(f"Total chunks created: {len(text_chunks)}")
-    print("Loading sentence-transformers model:", EMBED_MODEL)
-    model = SentenceTransformer(EMBED_MODEL)
+
+    # Identical chunks (boilerplate repeated across pages) are encoded once and
+    # scattered back; metas still point at every page they came from.
+    unique_ids = {}
+    inverse = np.fromiter(
+        (unique_ids.setdefault(c, len(unique_ids)) for c in text_chunks), dtype=np.int64, count=len(text_chunks)
+    )
+    unique_chunks = list(unique_ids)
+    print(f"Unique chunks to encode: {len(unique_chunks)}")
 
     # encode all chunks (this runs locally)
     print("Computing embeddings (locally)...")
-    embeddings = model.encode(text_chunks, show_progress_bar=True, convert_to_numpy=True)
+    if len(unique_chunks) > MULTI_PROCESS_MIN_CHUNKS and not torch.cuda.is_available():
+        unique_embeddings = embed_chunks_multi_process(model, unique_chunks)
+    else:
+        torch.set_num_threads(os.cpu_count() or 1)
+        unique_embeddings = embed_chunks(model, unique_chunks)
+    embeddings = unique_embeddings[inverse]
 
     os.makedirs("data", exist_ok=True)
-    np.save(EMBED_FILE, embeddings)
-    with open(META_FILE, "w", encoding="utf-8") as f:
-        json.dump(metas, f, indent=2, ensure_ascii=False)
+    # Like the other data files, written to a temp file and swapped in, since rag.py keeps
+    # embeddings.npy memory-mapped (np.save on a handle so it doesn't append ".npy").
+    with open(EMBED_FILE + ".tmp", "wb") as f:
+        np.save(f, embeddings.astype(np.float16))
+    os.replace(EMBED_FILE + ".tmp", EMBED_FILE)
+    if faiss is not None:
+        # Persist the search index so rag.py can memory-map it instead of rebuilding.
+        # Swapped in via a temp file so a running server's mapping stays valid.
+        faiss.write_index(build_faiss_index(embeddings), INDEX_FILE + ".tmp")
+        os.replace(INDEX_FILE + ".tmp", INDEX_FILE)
+    # Chunk texts go into one flat UTF-8 file; metas only keep byte offsets into it, so
+    # rag.py can memory-map the file and read just the top_k hits.
+    # Written to a temp file and swapped in, so a running server's mapping stays valid.
+    offset = 0
+    with open(CHUNKS_FILE + ".tmp", "wb") as f:
+        for chunk, meta in zip(text_chunks, metas):
+            data = chunk.encode("utf-8")
+            f.write(data)
+            meta["start"], meta["len"] = offset, len(data)
+            offset += len(data)
+    os.replace(CHUNKS_FILE + ".tmp", CHUNKS_FILE)
+    # index.fingerprint is computed from metadata.json, so it must never be seen half-written
+    with open(META_FILE + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(metas, f, ensure_ascii=False)
+    os.replace(META_FILE + ".tmp", META_FILE)
+    if faiss is not None:
+        with open(INDEX_FINGERPRINT_FILE, "w", encoding="utf-8") as f:
+            f.write(file_fingerprint(META_FILE))
 
-    print("✅ Saved embeddings and metadata.")
+    print("✅ Saved embeddings, index, chunks and metadata.")
     return embeddings, metas
 
+def export_onnx_model(out_dir=ONNX_MODEL_DIR, quantize=True):
+    """Export EMBED_MODEL to ONNX (optionally dynamic INT8) for faster query encoding in rag.py."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model_id = f"sentence-transformers/{EMBED_MODEL}"
+    print("Exporting to ONNX:", model_id)
+    ort_model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    ort_model.save_pretrained(out_dir)
+    tokenizer.save_pretrained(out_dir)
+
+    if quantize:
+        # Dynamic INT8 quantization of MatMul/Gemm weights (uses VNNI where available)
+        print("Quantizing ONNX model to INT8...")
+        quantizer = ORTQuantizer.from_pretrained(ort_model)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=out_dir, quantization_config=qconfig)
+
+    print("✅ Saved ONNX model to", out_dir)
+
 if __name__ == "__main__":
     build_index()
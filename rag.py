@@ -1,9 +1,46 @@
 import os
 import json
+import asyncio
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
+import torch
+from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+# Data file paths and the embedding model are shared with ingest.py so the two can't drift apart
+from ingest import (
+    CHUNKS_FILE,
+    EMBED_FILE,
+    EMBED_MODEL,
+    INDEX_FILE,
+    INDEX_FINGERPRINT_FILE,
+    META_FILE,
+    ONNX_MODEL_DIR,
+    build_faiss_index,
+    file_fingerprint,
+    normalize_rows,
+)
+
+try:
+    import faiss
+except ImportError:  # e.g. no faiss-cpu wheel for this platform; fall back to a numba kernel
+    faiss = None
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def cosine_sims(emb, q):
+        """Dot product of every (normalized) embedding row with the (normalized) query."""
+        n, dim = emb.shape
+        sims = np.empty(n, dtype=np.float32)
+        for i in prange(n):
+            s = np.float32(0.0)
+            for j in range(dim):
+                s += emb[i, j] * q[j]
+            sims[i] = s
+        return sims
 
 # Load environment variables
 load_dotenv()
@@ -12,15 +49,30 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_PROJECT_ID = os.getenv("OPENAI_PROJECT_ID")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Query-encoder precision: "fp32", "bf16" (CPU/GPU autocast) or "fp16" (GPU only)
+EMBED_PRECISION = os.getenv("EMBED_PRECISION", "fp32").lower()
 
 # Debug print (safe)
 print("Loaded API key (first 10 chars):", (OPENAI_API_KEY or "")[:10])
 print("Loaded Project ID:", OPENAI_PROJECT_ID)
 print("Loaded Model:", OPENAI_MODEL)
+print("Embedding precision:", EMBED_PRECISION)
 
 # File paths
-EMBED_FILE = "data/embeddings.npy"
-META_FILE = "data/metadata.json"
+BATCH_FILE = "data/batch_requests.jsonl"
+
+MAX_SEQ_LENGTH = 256
+
+# Optional INT8 file inside ONNX_MODEL_DIR (see ingest.export_onnx_model)
+ONNX_QUANT_FILE = "model_quantized.onnx"
+
+# Concurrent retrieve() calls are encoded + searched together in batches of up to this size
+QUERY_BATCH_MAX_SIZE = 32
+# Seconds a retrieve() call waits for its batch (the first one may include loading the index)
+RETRIEVE_TIMEOUT = 120
+
+# Number of (question, model, top_k) answers kept in the in-process LRU cache
+ANSWER_CACHE_SIZE = 256
 
 # Initialize OpenAI client
 openai_client = None
@@ -35,39 +87,191 @@ else:
 # Globals
 embeddings = None
 metas = None
-nn = None
+chunks_mm = None
+index = None  # FAISS index, or the normalized embedding matrix when FAISS is unavailable
+_ST_MODEL = None
+_ORT_MODEL = None
+_ORT_TOKENIZER = None
+_ORT_CHECKED = False
+_query_queue = queue.Queue()
+_batch_thread = None
+_batch_thread_lock = threading.Lock()
+_answer_cache = OrderedDict()
+_answer_cache_lock = threading.Lock()
+
+
+def get_st_model():
+    """Return the sentence-transformers model, loading it once per process."""
+    global _ST_MODEL
+    if _ST_MODEL is None:
+        _ST_MODEL = SentenceTransformer(EMBED_MODEL)
+        if EMBED_PRECISION == "fp16" and _ST_MODEL.device.type == "cuda":
+            _ST_MODEL.half()
+        _ST_MODEL.eval()
+    return _ST_MODEL
+
+
+def get_ort_model():
+    """Return (model, tokenizer) for the ONNX query encoder, or (None, None) if it isn't available."""
+    global _ORT_MODEL, _ORT_TOKENIZER, _ORT_CHECKED
+    if not _ORT_CHECKED:
+        _ORT_CHECKED = True
+        if os.path.isdir(ONNX_MODEL_DIR):
+            try:
+                from optimum.onnxruntime import ORTModelForFeatureExtraction
+                from transformers import AutoTokenizer
+
+                kwargs = {}
+                if os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_QUANT_FILE)):
+                    kwargs["file_name"] = ONNX_QUANT_FILE
+                _ORT_MODEL = ORTModelForFeatureExtraction.from_pretrained(
+                    ONNX_MODEL_DIR, provider="CPUExecutionProvider", **kwargs
+                )
+                _ORT_TOKENIZER = AutoTokenizer.from_pretrained(ONNX_MODEL_DIR)
+            except Exception as e:
+                print("⚠️ Warning: Could not load ONNX encoder, using PyTorch:", e)
+                _ORT_MODEL = _ORT_TOKENIZER = None
+    return _ORT_MODEL, _ORT_TOKENIZER
+
+
+def encode_queries(texts):
+    """Embed texts as L2-normalized float32 vectors, via ONNX Runtime when exported."""
+    ort_model, tokenizer = get_ort_model()
+    if ort_model is None:
+        st_model = get_st_model()
+        if EMBED_PRECISION == "bf16":
+            # Only faster on hardware with native BF16 matmul (AVX-512 BF16 / AMX, Ampere+)
+            with torch.autocast(device_type=st_model.device.type, dtype=torch.bfloat16):
+                q_emb = st_model.encode(texts, convert_to_tensor=True, normalize_embeddings=True)
+        else:
+            q_emb = st_model.encode(texts, convert_to_tensor=True, normalize_embeddings=True)
+        # Back to float32 (numpy has no bfloat16) and renormalize to match the corpus vectors
+        return normalize_rows(q_emb.float().cpu().numpy())
+
+    enc = tokenizer(texts, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors="np")
+    hidden = ort_model(**enc).last_hidden_state
+    # Mean pooling over non-padding tokens, as in the sentence-transformers model
+    mask = enc["attention_mask"][..., None].astype(np.float32)
+    q_emb = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    return normalize_rows(q_emb)
 
 
 def load_index():
-    """Load embeddings and metadata, build nearest neighbor index."""
-    global embeddings, metas, nn
+    """Load embeddings and metadata, build the search index."""
+    global embeddings, metas, chunks_mm, index
     if embeddings is None:
-        embeddings = np.load(EMBED_FILE)
+        # Memory-mapped so pages are read on demand and shared between processes
+        embeddings = np.load(EMBED_FILE, mmap_mode="r")
     if metas is None:
         with open(META_FILE, "r", encoding="utf-8") as f:
             metas = json.load(f)
-    nn = NearestNeighbors(n_neighbors=8, metric="cosine")
-    nn.fit(embeddings)
-    return nn
+    if chunks_mm is None and os.path.exists(CHUNKS_FILE):
+        chunks_mm = np.memmap(CHUNKS_FILE, dtype=np.uint8, mode="r")
+    if faiss is not None:
+        index = None
+        if os.path.exists(INDEX_FILE):
+            saved = None
+            if os.path.exists(INDEX_FINGERPRINT_FILE):
+                with open(INDEX_FINGERPRINT_FILE, "r", encoding="utf-8") as f:
+                    saved = f.read().strip()
+            if saved == file_fingerprint(META_FILE):
+                # IO_FLAG_MMAP_IFC maps the stored vectors instead of copying them onto the heap
+                index = faiss.read_index(INDEX_FILE, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+            else:
+                print("⚠️ Warning: Saved index doesn't match metadata, rebuilding it")
+        if index is None:
+            index = build_faiss_index(embeddings)
+    else:
+        index = normalize_rows(embeddings)
+        cosine_sims(index, index[0])  # warm up: pay the JIT compile cost at load time
+    # Preload the query encoder so the first request doesn't pay for it
+    if get_ort_model()[0] is None:
+        get_st_model()
+    return index
 
 
-def retrieve(query, top_k=4):
-    """Retrieve top_k similar docs."""
-    global nn, embeddings, metas
-    if nn is None:
-        nn = load_index()
+def load_index_if_present():
+    """Eagerly load the index at server start, if `ingest.py` has been run."""
+    if os.path.exists(EMBED_FILE) and os.path.exists(META_FILE):
+        load_index()
+
+
+def search(q_emb, top_k):
+    """Return (similarities, indices), each of shape (n_queries, top_k), best first."""
+    if faiss is not None:
+        return index.search(q_emb, top_k)
+    if len(q_emb) > 1:
+        sims = q_emb @ index.T  # one BLAS GEMM for the whole batch
+    else:
+        sims = cosine_sims(index, q_emb[0])[None, :]
+    # O(n) partition to find the top_k, then sort only those k
+    top_k = min(top_k, sims.shape[1])
+    idxs = np.argpartition(-sims, top_k - 1, axis=1)[:, :top_k]
+    top_sims = np.take_along_axis(sims, idxs, axis=1)
+    order = np.argsort(-top_sims, axis=1)
+    return np.take_along_axis(top_sims, order, axis=1), np.take_along_axis(idxs, order, axis=1)
 
-    from sentence_transformers import SentenceTransformer
-    st_model = SentenceTransformer("all-MiniLM-L6-v2")
-    q_emb = st_model.encode([query], convert_to_numpy=True)
 
-    distances, idxs = nn.kneighbors(q_emb.reshape(1, -1), n_neighbors=top_k)
-    results = []
-    for d, idx in zip(distances[0], idxs[0]):
-        meta = metas[idx]
-        similarity = 1.0 - float(d)  # cosine distance -> similarity
-        results.append({"meta": meta, "similarity": similarity})
-    return results
+def get_excerpt(meta):
+    """Return the chunk text for a hit, read from the memory-mapped chunks file."""
+    if chunks_mm is not None and "start" in meta:
+        return bytes(chunks_mm[meta["start"]:meta["start"] + meta["len"]]).decode("utf-8")
+    # Metadata written before chunks.txt existed stores the excerpt inline
+    return meta.get("text_excerpt", "")
+
+
+def retrieve_batch(queries, top_k=4):
+    """Retrieve top_k similar docs for each query with a single encode + search."""
+    global index
+    if index is None:
+        index = load_index()
+
+    q_emb = encode_queries(list(queries))
+    sims, idxs = search(q_emb, top_k)
+    return [
+        [{"meta": metas[i], "similarity": float(s)} for s, i in zip(row_sims, row_idxs) if i >= 0]
+        for row_sims, row_idxs in zip(sims, idxs)
+    ]
+
+
+def _batch_worker():
+    """Collect pending retrieve() calls and answer them with one retrieve_batch() each round."""
+    while True:
+        batch = [_query_queue.get()]
+        # Take whatever is already queued without waiting; queries arriving while this
+        # batch is encoded are picked up next round, so a lone query pays no delay.
+        while len(batch) < QUERY_BATCH_MAX_SIZE:
+            try:
+                batch.append(_query_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        top_k = max(k for _, k, _ in batch)
+        try:
+            results = retrieve_batch([q for q, _, _ in batch], top_k=top_k)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            continue
+        for (_, k, future), res in zip(batch, results):
+            future.set_result(res[:k])
+
+
+def _ensure_batch_thread():
+    # Also restarts the worker in forked processes, where the parent's thread doesn't exist
+    global _batch_thread
+    with _batch_thread_lock:
+        if _batch_thread is None or not _batch_thread.is_alive():
+            _batch_thread = threading.Thread(target=_batch_worker, name="rag-query-batcher", daemon=True)
+            _batch_thread.start()
+
+
+def retrieve(query, top_k=4):
+    """Retrieve top_k similar docs; concurrent callers share one batched encode + search."""
+    _ensure_batch_thread()
+    future = Future()
+    _query_queue.put((query, top_k, future))
+    return future.result(timeout=RETRIEVE_TIMEOUT)
 
 
 PROMPT_TEMPLATE = """
@@ -99,34 +303,31 @@ User Question:
 """
 
 
-def answer_query(question, top_k=4):
+SYSTEM_PROMPT = "You are a strict assistant that answers only from the provided docs and must follow the response format."
+
+CHAT_PARAMS = {"max_tokens": 800, "temperature": 0.0}
+
+
+def build_prompt(question, results):
+    """Return (prompt, context) for the retrieved snippets."""
     snippets = []
-    results = retrieve(question, top_k=top_k)
     for r in results:
         m = r["meta"]
         snippets.append(
-            f"---\nTitle: {m.get('title','')}\nURL: {m.get('url','')}\nExcerpt: {m.get('text_excerpt','')}\nSimilarity: {r['similarity']:.4f}"
+            f"---\nTitle: {m.get('title','')}\nURL: {m.get('url','')}\nExcerpt: {get_excerpt(m)}\nSimilarity: {r['similarity']:.4f}"
         )
     context = "\n\n".join(snippets)
-    prompt = PROMPT_TEMPLATE.format(snippets=context, question=question)
-
-    if openai_client:
-        resp = openai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a strict assistant that answers only from the provided docs and must follow the response format.",
-                },
-                {"role": "user", "content": prompt},
-            ],
-            max_tokens=800,
-            temperature=0.0,
-        )
-        content = resp.choices[0].message.content.strip()
-    else:
-        content = "⚠️ OpenAI API key not found. Here are the retrieved snippets:\n\n" + context
+    return PROMPT_TEMPLATE.format(snippets=context, question=question), context
+
+
+def chat_messages(prompt):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
 
+
+def format_response(content, results):
     avg_sim = sum([r["similarity"] for r in results]) / max(1, len(results))
     citations = [
         {
@@ -139,6 +340,148 @@ def answer_query(question, top_k=4):
     return {"answer": content, "citations": citations, "confidence": float(avg_sim)}
 
 
+def _cache_get(key):
+    with _answer_cache_lock:
+        if key in _answer_cache:
+            _answer_cache.move_to_end(key)
+            return _answer_cache[key]
+    return None
+
+
+def _cache_put(key, value):
+    with _answer_cache_lock:
+        _answer_cache[key] = value
+        _answer_cache.move_to_end(key)
+        while len(_answer_cache) > ANSWER_CACHE_SIZE:
+            _answer_cache.popitem(last=False)
+
+
+def answer_query(question, top_k=4):
+    key = (question, OPENAI_MODEL, top_k)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    results = retrieve(question, top_k=top_k)
+    prompt, context = build_prompt(question, results)
+
+    if not openai_client:
+        content = "⚠️ OpenAI API key not found. Here are the retrieved snippets:\n\n" + context
+        return format_response(content, results)
+
+    resp = openai_client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=chat_messages(prompt),
+        **CHAT_PARAMS,
+    )
+    content = resp.choices[0].message.content.strip()
+    response = format_response(content, results)
+    _cache_put(key, response)
+    return response
+
+
+def stream_answer(question, top_k=4):
+    """Yield the answer as events: citations first, then answer text deltas as the LLM produces them."""
+    key = (question, OPENAI_MODEL, top_k)
+    cached = _cache_get(key)
+    if cached is not None:
+        yield {"type": "citations", "citations": cached["citations"], "confidence": cached["confidence"]}
+        yield {"type": "delta", "content": cached["answer"]}
+        return
+
+    results = retrieve(question, top_k=top_k)
+    prompt, context = build_prompt(question, results)
+    response = format_response("", results)
+    # Sources are known before the LLM call, so send them right away
+    yield {"type": "citations", "citations": response["citations"], "confidence": response["confidence"]}
+
+    if not openai_client:
+        yield {"type": "delta", "content": "⚠️ OpenAI API key not found. Here are the retrieved snippets:\n\n" + context}
+        return
+
+    parts = []
+    # The context manager closes the upstream connection if the client disconnects
+    # and Flask closes this generator mid-stream
+    with openai_client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=chat_messages(prompt),
+        stream=True,
+        **CHAT_PARAMS,
+    ) as stream:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield {"type": "delta", "content": delta}
+    response["answer"] = "".join(parts).strip()
+    _cache_put(key, response)
+
+
+async def answer_query_async(question, top_k=4, client=None):
+    """Same as answer_query, but awaits the LLM call so many questions can run concurrently."""
+    key = (question, OPENAI_MODEL, top_k)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    results = await asyncio.to_thread(retrieve, question, top_k)
+    prompt, context = build_prompt(question, results)
+
+    if not client:
+        content = "⚠️ OpenAI API key not found. Here are the retrieved snippets:\n\n" + context
+        return format_response(content, results)
+
+    resp = await client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=chat_messages(prompt),
+        **CHAT_PARAMS,
+    )
+    content = resp.choices[0].message.content.strip()
+    response = format_response(content, results)
+    _cache_put(key, response)
+    return response
+
+
+async def answer_queries(questions, top_k=4):
+    """Answer several questions concurrently; results are in the same order as questions."""
+    if not OPENAI_API_KEY:
+        return await asyncio.gather(*(answer_query_async(q, top_k=top_k) for q in questions))
+    # The async client's connection pool is tied to the running event loop, and Flask
+    # runs each async view in a fresh loop, so create one client per call.
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY) as client:
+        return await asyncio.gather(*(answer_query_async(q, top_k=top_k, client=client) for q in questions))
+
+
+def submit_batch_job(questions, top_k=4, out_path=BATCH_FILE):
+    """Submit questions to the OpenAI Batch API for offline answering; returns the batch object."""
+    if not openai_client:
+        raise RuntimeError("OpenAI API key not found")
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        for i, question in enumerate(questions):
+            prompt, _ = build_prompt(question, retrieve(question, top_k=top_k))
+            line = {
+                "custom_id": f"question-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": OPENAI_MODEL, "messages": chat_messages(prompt), **CHAT_PARAMS},
+            }
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    with open(out_path, "rb") as f:
+        batch_input = openai_client.files.create(file=f, purpose="batch")
+    batch = openai_client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print("Submitted batch:", batch.id)
+    return batch
+
+
 if __name__ == "__main__":
     q = "Give me the curl command to create a ticket."
     result = answer_query(q)
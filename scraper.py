@@ -1,32 +1,45 @@
 # scraper.py
-import requests
+import asyncio
+import aiohttp
 from bs4 import BeautifulSoup
+from collections import Counter, defaultdict
 from urllib.parse import urljoin, urlparse
 import json
-import time
 import os
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (compatible; FreshserviceScraper/1.0)"
 }
 
-def fetch(url, retries=3, backoff=1.0):
+CONCURRENCY = 16  # max in-flight requests per host
+REQUEST_TIMEOUT = 15
+POLITENESS_DELAY = 0.5  # seconds each request slot waits after a fetch
+HTML_PARSER = "lxml"  # C-backed, much faster than "html.parser"
+# Page chrome that often survives inside the main content element
+BOILERPLATE_SELECTORS = ["nav", "footer", "aside", "script", "style", ".sidebar", ".toc"]
+# Text blocks found on at least this many pages are treated as boilerplate
+REPEATED_BLOCK_MIN_PAGES = 3
+
+async def fetch(session, url, retries=3, backoff=1.0):
     for i in range(retries):
         try:
-            r = requests.get(url, headers=HEADERS, timeout=15)
-            r.raise_for_status()
-            return r.text
+            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+            async with session.get(url, timeout=timeout) as r:
+                r.raise_for_status()
+                return await r.text()
         except Exception as e:
             if i == retries - 1:
                 raise
-            time.sleep(backoff * (i + 1))
+            await asyncio.sleep(backoff * (i + 1))
     raise RuntimeError("unreachable")
 
-def extract_text_from_page(html, base_url):
-    soup = BeautifulSoup(html, "html.parser")
+def extract_text_from_page(soup, base_url):
     main = soup.find("main") or soup.find("article") or soup.find("div", class_="content") or soup.body
     if main is None:
         return "", ""
+    # Note: this mutates the soup, so collect links before calling it
+    for el in main.select(", ".join(BOILERPLATE_SELECTORS)):
+        el.decompose()
     title_tag = main.find(['h1','h2','h3']) or soup.title
     title = title_tag.get_text(strip=True) if title_tag else base_url
     parts = []
@@ -37,8 +50,7 @@ def extract_text_from_page(html, base_url):
     content = "\n\n".join(parts)
     return title, content
 
-def get_links(html, base):
-    soup = BeautifulSoup(html, "html.parser")
+def get_links(soup, base):
     links = set()
     base_domain = urlparse(base).netloc
     for a in soup.find_all("a", href=True):
@@ -51,41 +63,92 @@ def get_links(html, base):
             links.add(abs_url.split("#")[0])
     return list(links)
 
-def scrape(start_url, out_path="data/docs.json", max_pages=200):
+def strip_repeated_blocks(docs, min_pages=REPEATED_BLOCK_MIN_PAGES):
+    r"""Drop content blocks (paragraphs, list items, ...) that appear on min_pages or more pages.
+
+    Pages with identical content (e.g. one page fetched under two URLs) count once,
+    so their shared text isn't mistaken for boilerplate:
+
+    >>> page = {"content": "Create a Ticket\n\nFooter"}
+    >>> docs = [dict(page, url="/#a"), dict(page, url="/"), {"url": "/v1", "content": "Footer"}]
+    >>> [d["content"] for d in strip_repeated_blocks(docs)]
+    ['Create a Ticket\n\nFooter', 'Create a Ticket\n\nFooter', 'Footer']
+    """
+    page_counts = Counter()
+    for content in {doc["content"] for doc in docs}:
+        page_counts.update(set(content.split("\n\n")))
+    repeated = {block for block, n in page_counts.items() if n >= min_pages}
+    for doc in docs:
+        blocks = doc["content"].split("\n\n")
+        doc["content"] = "\n\n".join(b for b in blocks if b not in repeated)
+    return docs
+
+async def scrape_async(start_url, out_path="data/docs.json", max_pages=200, concurrency=CONCURRENCY):
     os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
-    to_visit = [start_url]
+    to_visit = asyncio.Queue()
+    # Normalized like get_links() (no #fragment), so the start page isn't crawled twice
+    start = start_url.split("#")[0]
+    to_visit.put_nowait(start)
+    # Every URL ever enqueued, so each page enters the frontier at most once
+    queued = {start}
     visited = set()
     docs = []
-    while to_visit and len(visited) < max_pages:
-        url = to_visit.pop(0)
-        if url in visited:
-            continue
-        print("Scraping:", url)
-        try:
-            html = fetch(url)
-        except Exception as e:
-            print("Failed to fetch", url, e)
-            visited.add(url)
-            continue
-        try:
-            title, content = extract_text_from_page(html, url)
-            docs.append({"url": url, "title": title, "content": content})
-        except Exception as e:
-            print("Failed to parse", url, e)
-        visited.add(url)
-        try:
-            links = get_links(html, start_url)
-            for l in links:
-                if l not in visited and l not in to_visit:
-                    to_visit.append(l)
-        except Exception:
-            pass
-        time.sleep(0.5)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(concurrency))
+
+    async def worker(session):
+        while True:
+            url = await to_visit.get()
+            try:
+                if len(visited) >= max_pages:
+                    continue
+                visited.add(url)
+                print("Scraping:", url)
+                try:
+                    async with host_limits[urlparse(url).netloc]:
+                        html = await fetch(session, url)
+                        await asyncio.sleep(POLITENESS_DELAY)
+                except Exception as e:
+                    print("Failed to fetch", url, e)
+                    continue
+                # Parse once and share the tree between text and link extraction
+                try:
+                    soup = await asyncio.to_thread(BeautifulSoup, html, HTML_PARSER)
+                except Exception as e:
+                    print("Failed to parse", url, e)
+                    continue
+                # Links first: text extraction strips nav/footer elements from the soup
+                try:
+                    links = await asyncio.to_thread(get_links, soup, start_url)
+                    for l in links:
+                        if l not in queued:
+                            queued.add(l)
+                            to_visit.put_nowait(l)
+                except Exception:
+                    pass
+                try:
+                    title, content = await asyncio.to_thread(extract_text_from_page, soup, url)
+                    docs.append({"url": url, "title": title, "content": content})
+                except Exception as e:
+                    print("Failed to parse", url, e)
+            finally:
+                to_visit.task_done()
+
+    async with aiohttp.ClientSession(headers=HEADERS) as session:
+        workers = [asyncio.create_task(worker(session)) for _ in range(concurrency)]
+        await to_visit.join()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    strip_repeated_blocks(docs)
     with open(out_path, "w", encoding="utf-8") as f:
         json.dump(docs, f, indent=2, ensure_ascii=False)
     print(f"Saved {len(docs)} pages to {out_path}")
     return docs
 
+def scrape(start_url, out_path="data/docs.json", max_pages=200):
+    return asyncio.run(scrape_async(start_url, out_path=out_path, max_pages=max_pages))
+
 if __name__ == "__main__":
     START = "https://api.freshservice.com/#ticket_attributes"
     scrape(START, out_path="data/docs.json", max_pages=300)